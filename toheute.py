@@ -4,32 +4,61 @@
 # requires-python = ">=3.13"
 # dependencies = [
 #    "click>=8.2.0",
-#    "gitpython>=3.1.44",
 #    "rich>=13.9.4",
 # ]
 # ///
 
+from __future__ import annotations
+
 import contextlib
 import dataclasses
+import functools
+import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import termios
+import threading
+import time
+import tty
 from pathlib import Path
-from subprocess import CompletedProcess
-from typing import Iterable, Literal, NoReturn
+from subprocess import PIPE, CompletedProcess
+from typing import IO, TYPE_CHECKING, Callable, Iterable, Iterator, Literal, NoReturn
 
 import click
-from git import InvalidGitRepositoryError, Repo
-from rich.console import Console
-from rich.prompt import Prompt
-from rich.padding import Padding, PaddingDimensions
-from rich.status import Status
+
+if TYPE_CHECKING:
+    # rich is imported lazily, so that e.g. `--help` doesn't pay for it.
+    from rich.padding import PaddingDimensions
+    from rich.status import Status
 
 PATH_PREFIX_BLOCK_LIST = (".werks", "bin", "packages", "tests")
 PATH_PREFIX_ALLOW_LIST = ("packages/cmk-frontend",)
+FRONTEND_SRC_PREFIX = "packages/cmk-frontend/src/"
+COPY_CHUNK_SIZE = 1 << 20
+MAX_PARALLEL_COPIES = 8
+STEP_MARKER = "==="
+SUDO_REFRESH_INTERVAL = 240  # seconds, below sudo's default 5 minute timeout
+SITES_CACHE_TTL = 60  # seconds
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "toheute"
 
 type PadVariant = Literal["extra", "top"] | None
 type StyleVariant = Literal["success", "danger", "warn", "muted"] | None
 
+PADDING_VALUES: dict[PadVariant, PaddingDimensions] = {
+    "extra": (1, 2),
+    "top": (1, 0, 0, 2),
+    None: (0, 0, 0, 2),
+}
+STYLE_VALUES: dict[StyleVariant, str] = {
+    "success": "green",
+    "danger": "red",
+    "warn": "yellow",
+    "muted": "gray50",
+    None: "black",
+}
+
 
 @click.command()
 @click.option("--n-commits", "-n", default=1, help="Number of commits to sync.")
@@ -46,7 +75,7 @@ def main(n_commits: int, gui: bool, full: bool) -> None:
     paths_to_sync = set()
     for offset, commit in enumerate(repo.get_commits(n_commits)):
         repo.print_commit_info(commit, offset)
-        paths_to_sync.update(commit.get_valid_paths())
+        paths_to_sync.update(commit.valid_paths)
 
     if not paths_to_sync:
         console.exit("No paths available to copy.", style="warn")
@@ -54,16 +83,27 @@ def main(n_commits: int, gui: bool, full: bool) -> None:
     if not console.confirm():
         console.exit("No paths to copy.", style="success")
 
-    with console.in_progress("Syncing files"):
-        FileManager(site, paths_to_sync, console).sync()
+    # Only ask for sudo if a copy or restart actually needs it.
+    file_manager = FileManager(site, paths_to_sync, console)
+    needs_sudo = file_manager.needs_sudo or gui or full
+    with sudo_session(console) if needs_sudo else contextlib.nullcontext():
+        with console.in_progress("Syncing files"):
+            file_manager.sync()
+        file_manager.print_results()
 
-    with console.in_progress("Reloading services"):
-        site_controller.restart_services(gui, full)
+        with console.in_progress("Reloading services"):
+            site_controller.restart_services(gui, full)
 
 
 class AppConsole:
     def __init__(self) -> None:
-        self._console = Console()
+        from rich.console import Console
+        from rich.padding import Padding
+
+        # Output is mostly paths and command logs, which gain nothing from
+        # markup parsing or highlighting but would pay for it on every print.
+        self._console = Console(highlight=False, markup=False, emoji=False)
+        self._padding = Padding
         self._console.clear()
 
     def heading(self, msg: str) -> None:
@@ -72,9 +112,20 @@ class AppConsole:
     def print(
         self, msg: str, *, pad: PadVariant = None, style: StyleVariant = None
     ) -> None:
-        pad_ = self._get_padding_value(pad)
-        style_ = self._get_style_value(style)
-        self._console.print(Padding(msg, pad=pad_), style=style_)
+        self._console.print(
+            self._padding(msg, pad=PADDING_VALUES[pad]), style=STYLE_VALUES[style]
+        )
+
+    def print_results(self, results: Iterable[tuple[bool, str]]) -> None:
+        from rich.table import Table
+        from rich.text import Text
+
+        # Rendered as one table, so all rows are written to the terminal at once.
+        table = Table(show_header=False, box=None, padding=(0, 1, 0, 0))
+        for ok, name in results:
+            mark = Text("✓", style="green") if ok else Text("𐄂", style="red")
+            table.add_row(mark, name)
+        self._console.print(self._padding(table, pad=PADDING_VALUES[None]))
 
     def exit(self, msg: str, *, style: StyleVariant) -> NoReturn:
         exit_code = 1 if style == "danger" else 0
@@ -82,37 +133,38 @@ class AppConsole:
         sys.exit(exit_code)
 
     def prompt(self, msg: str, *, default: str, choices: list[str]) -> str:
+        from rich.prompt import Prompt
+
         m = f"  {msg}"  # unfortunately, can't apply padding to Prompt.ask.
         return Prompt.ask(m, console=self._console, default=default, choices=choices)
 
-    def confirm(self) -> bool:
-        return self.prompt("Proceed", default="y", choices=["y", "n"]) == "y"
+    def confirm(self, default: str = "y") -> bool:
+        if not sys.stdin.isatty():
+            return self.prompt("Proceed", default=default, choices=["y", "n"]) == "y"
+
+        # A single keypress is enough to answer, no need to wait for Enter.
+        self._console.print(f"  Proceed [y/n] ({default}): ", end="")
+        while (key := self._read_key()) not in ("y", "n", "\r", "\x1b"):
+            if key in ("\x03", "\x04"):  # Ctrl-C, Ctrl-D
+                self._console.print()
+                raise KeyboardInterrupt
+        choice = {"\r": default, "\x1b": "n"}.get(key, key)
+        self._console.print(choice)
+        return choice == "y"
 
     def in_progress(self, label: str) -> Status:
         self._console.print()
         return self._console.status(f"[blue]{label}...", spinner="dots3")
 
-    def _get_padding_value(self, variant: PadVariant) -> PaddingDimensions:
-        match variant:
-            case "extra":
-                return (1, 2)
-            case "top":
-                return (1, 0, 0, 2)
-            case _:
-                return (0, 0, 0, 2)
-
-    def _get_style_value(self, variant: StyleVariant) -> str:
-        match variant:
-            case "success":
-                return "green"
-            case "danger":
-                return "red"
-            case "warn":
-                return "yellow"
-            case "muted":
-                return "gray50"
-            case _:
-                return "black"
+    @staticmethod
+    def _read_key() -> str:
+        fd = sys.stdin.fileno()
+        settings = termios.tcgetattr(fd)
+        try:
+            tty.setraw(fd)
+            return os.read(fd, 1).decode("utf-8", "replace").lower()
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, settings)
 
 
 class SiteManager:
@@ -134,8 +186,12 @@ class SiteManager:
 
     @staticmethod
     def get_site_names() -> list[str]:
-        raw_sites = subprocess.check_output(["omd", "sites", "--bare"]).decode("utf-8")
-        return [site for site in raw_sites.rstrip("\n").split("\n")]
+        raw_sites = cached_output(
+            "sites",
+            SITES_CACHE_TTL,
+            lambda: subprocess.check_output(["omd", "sites", "--bare"]),
+        )
+        return raw_sites.decode("utf-8").splitlines()
 
     @staticmethod
     def get_site_from_environment() -> str:
@@ -168,35 +224,54 @@ class Commit:
     author: str
     time: str
     message: str
-    filepaths: list[Path]
+    filepaths: list[str]
+
+    @property
+    def valid_paths(self) -> list[str]:
+        return self._partitioned_paths[0]
 
-    def get_valid_paths(self) -> list[Path]:
-        return [fp for fp in self.filepaths if self._is_valid_path(fp)]
+    @property
+    def invalid_paths(self) -> list[str]:
+        return self._partitioned_paths[1]
 
-    def get_invalid_paths(self) -> list[Path]:
-        return [fp for fp in self.filepaths if not self._is_valid_path(fp)]
+    @functools.cached_property
+    def _partitioned_paths(self) -> tuple[list[str], list[str]]:
+        valid: list[str] = []
+        invalid: list[str] = []
+        for fp in self.filepaths:
+            (valid if self._is_valid_path(fp) else invalid).append(fp)
+        return valid, invalid
 
-    def _is_valid_path(self, fpath: Path) -> bool:
-        in_block_list = str(fpath).startswith(PATH_PREFIX_BLOCK_LIST)
-        in_allow_list = str(fpath).startswith(PATH_PREFIX_ALLOW_LIST)
-        return not in_block_list or in_allow_list
+    def _is_valid_path(self, path: str) -> bool:
+        if not path.startswith(PATH_PREFIX_BLOCK_LIST):
+            return True
+        return path.startswith(PATH_PREFIX_ALLOW_LIST)
 
 
 class GitRepository:
     def __init__(self, console: AppConsole) -> None:
         self._console = console
-        self._git = self._load_git_repository()
+        self._root = self._load_git_repository()
 
     def get_commits(self, n: int) -> list[Commit]:
-        return [
-            Commit(
-                author=c.author.name,
-                time=c.committed_datetime.strftime("%Y-%m-%d %H:%M:%S"),
-                message=c.message,
-                filepaths=[Path(f) for f in c.stats.files.keys()],
-            )
-            for c in self._git.iter_commits(self._git.active_branch, max_count=n)
+        # A single `git log` yields metadata and files of all commits at once,
+        # instead of GitPython spawning another diff for the stats of each one.
+        args = [
+            "git",
+            "log",
+            f"--max-count={n}",
+            "--name-only",
+            "-z",
+            "--diff-merges=first-parent",
+            "--date=format:%Y-%m-%d %H:%M:%S",
+            "--format=%x1e%an%x00%cd%x00%B%x00",
+            "HEAD",
         ]
+        result = subprocess.run(args, cwd=self._root, capture_output=True)
+        if result.returncode != 0:
+            stderr = result.stderr.decode("utf-8", "replace").strip()
+            self._console.exit(f"Unable to read commits: {stderr}", style="danger")
+        return [self._parse_commit(r) for r in result.stdout.split(b"\x1e")[1:]]
 
     def print_commit_info(self, commit: Commit, offset: int) -> None:
         self._console.heading(f"HEAD~{offset}")
@@ -204,60 +279,149 @@ class GitRepository:
         self._console.print(f"{commit.message:.>30}", style="muted")
 
         self._console.print("The following files will be copied:")
-        for fp in commit.get_valid_paths():
-            self._console.print(str(fp), style="success")
+        if valid_paths := commit.valid_paths:
+            self._console.print("\n".join(valid_paths), style="success")
 
-        if invalid_paths := commit.get_invalid_paths():
+        if invalid_paths := commit.invalid_paths:
             self._console.print("Unable to sync the following files:", pad="top")
-            for fp in invalid_paths:
-                self._console.print(str(fp), style="warn")
+            self._console.print("\n".join(invalid_paths), style="warn")
         self._console.print("")
 
-    def _load_git_repository(self) -> Repo:
-        try:
-            return Repo(search_parent_directories=True)
-        except InvalidGitRepositoryError:
+    def _load_git_repository(self) -> Path:
+        args = ["git", "rev-parse", "--show-toplevel"]
+        result = subprocess.run(args, capture_output=True)
+        if result.returncode != 0:
             self._console.exit("Make sure you're in a git repository.", style="danger")
+        return Path(os.fsdecode(result.stdout.strip()))
+
+    @staticmethod
+    def _parse_commit(record: bytes) -> Commit:
+        # With -z, file names are NUL separated and never quoted by git. They
+        # are decoded like any other file system path, so they round trip.
+        author, time, message, files = record.split(b"\x00", 3)
+        return Commit(
+            author=author.decode("utf-8", "replace"),
+            time=time.decode("utf-8", "replace"),
+            message=message.decode("utf-8", "replace"),
+            filepaths=[
+                os.fsdecode(f) for f in files.lstrip(b"\x00\n").split(b"\x00") if f
+            ],
+        )
 
 
 class FileManager:
-    def __init__(self, site: str, paths: Iterable[Path], console: AppConsole) -> None:
-        self._site = site
-        self._paths = paths
+    def __init__(self, site: str, paths: Iterable[str], console: AppConsole) -> None:
         self._console = console
+        self._python_prefix = f"/omd/sites/{site}/lib/python3/"
+        self._plugins_prefix = f"/omd/sites/{site}/lib/nagios/plugins/"
+        self._htdocs_prefix = f"/omd/sites/{site}/share/check_mk/web/htdocs/"
+        self._writable: dict[Path, bool] = {}
+        self._results: list[tuple[bool, str]] = []
+        self._errors: list[str] = []
+        self._targets = {path: self._get_site_path(path) for path in paths}
+        self._privileged = {
+            path: site_path
+            for path, site_path in self._targets.items()
+            if not self._is_writable(site_path.parent)
+        }
+
+    @property
+    def needs_sudo(self) -> bool:
+        return bool(self._privileged)
 
     def sync(self) -> None:
-        for path in self._paths:
-            site_path = self._get_site_path(path)
-            self._ensure_directory_exists(site_path)
-            result = self._copy(path, site_path)
-            self._print_result(site_path, result)
-
-    def _get_site_path(self, fpath: Path) -> Path:
-        match fpath:
-            case path if str(path).startswith("active_checks"):
-                return Path(f"/omd/sites/{self._site}/lib/nagios/plugins") / fpath.name
-            case path if str(path).startswith("packages/cmk-frontend/src"):
-                rp = path.relative_to("packages/cmk-frontend/src")
-                return Path(f"/omd/sites/{self._site}/share/check_mk/web/htdocs") / rp
+        for path, site_path in self._targets.items():
+            if path in self._privileged:
+                continue
+            if error := self._copy_local(path, site_path):
+                self._errors.append(error)
+            self._results.append((error is None, str(site_path)))
+
+        if self._privileged:
+            result = self._copy_with_sudo(self._privileged)
+            self._record_result(self._privileged, result)
+
+    def print_results(self) -> None:
+        for error in self._errors:
+            self._console.print(f"ERROR: {error}", style="danger")
+        self._console.print_results(self._results)
+
+    def _get_site_path(self, path: str) -> Path:
+        match path:
+            case _ if path.startswith("active_checks"):
+                return Path(self._plugins_prefix + os.path.basename(path))
+            case _ if path.startswith(FRONTEND_SRC_PREFIX):
+                rp = path.removeprefix(FRONTEND_SRC_PREFIX)
+                return Path(self._htdocs_prefix + rp)
             case _:
-                return Path(f"/omd/sites/{self._site}/lib/python3") / fpath
+                return Path(self._python_prefix + path)
 
-    def _ensure_directory_exists(self, site_path: Path) -> None:
-        args = ["sudo", "mkdir", "-p", site_path.parent]
-        subprocess.run(args, capture_output=True, text=True)
+    def _is_writable(self, directory: Path) -> bool:
+        if directory not in self._writable:
+            self._writable[directory] = os.access(directory, os.W_OK)
+        return self._writable[directory]
 
-    def _copy(self, src_path: Path, site_path: Path) -> CompletedProcess:
-        args = ["sudo", "cp", "-R", src_path, site_path]
-        return subprocess.run(args, capture_output=True, text=True)
+    def _copy_local(self, src_path: str, site_path: Path) -> str | None:
+        # No need to fork sudo when already running as the site user. Symlinks
+        # are copied as links, just like `cp -R` does.
+        try:
+            if os.path.islink(src_path):
+                self._copy_link(src_path, site_path)
+            elif os.path.isdir(src_path):
+                shutil.copytree(src_path, site_path, symlinks=True, dirs_exist_ok=True)
+            else:
+                self._copy_file(src_path, site_path)
+        except OSError as e:
+            return str(e)
+        return None
 
-    def _print_result(self, path: Path, result: CompletedProcess) -> None:
-        name = str(path)
-        if result.returncode != 0:
-            self._console.print(f"ERROR: {result.stderr}", style="danger")
-            self._console.print(f"𐄂 {name}")
-        else:
-            self._console.print(f"✓ {name}")
+    @staticmethod
+    def _copy_link(src_path: str, site_path: Path) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(site_path)
+        os.symlink(os.readlink(src_path), site_path)
+
+    @staticmethod
+    def _copy_file(src_path: str, site_path: Path) -> None:
+        # Write next to the target and swap it in, so the site never picks up
+        # a partially written file.
+        fd, tmp_name = tempfile.mkstemp(
+            dir=site_path.parent, prefix=f".{site_path.name}."
+        )
+        try:
+            with os.fdopen(fd, "wb") as dst, open(src_path, "rb") as src:
+                while os.sendfile(dst.fileno(), src.fileno(), None, COPY_CHUNK_SIZE):
+                    pass
+            shutil.copystat(src_path, tmp_name)
+            os.replace(tmp_name, site_path)
+        except OSError:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_name)
+            raise
+
+    def _copy_with_sudo(self, targets: dict[str, Path]) -> CompletedProcess:
+        # A single privileged shell avoids paying sudo's startup cost per path,
+        # while xargs runs the independent copies in parallel. Each failed copy
+        # prints its destination to stdout.
+        parents = sorted({str(site_path.parent) for site_path in targets.values()})
+        workers = min(MAX_PARALLEL_COPIES, len(targets))
+        copy = 'cp -R "$1" "$2" || printf "%s\\0" "$2"'
+        script = f"mkdir -p \"$@\" && xargs -0 -n 2 -P {workers} sh -c '{copy}' sh"
+        args = ["sudo", "sh", "-c", script, "sh", *parents]
+        pairs = b"\0".join(os.fsencode(p) for pair in targets.items() for p in pair)
+        return subprocess.run(args, input=pairs, capture_output=True)
+
+    def _record_result(
+        self, targets: dict[str, Path], result: CompletedProcess
+    ) -> None:
+        if result.stderr:
+            self._errors.append(result.stderr.decode("utf-8", "replace"))
+        # A non-zero exit means the batch itself failed, e.g. in mkdir, so no
+        # copy can be trusted. Otherwise only the reported targets failed.
+        failed = set(result.stdout.split(b"\0"))
+        for site_path in targets.values():
+            ok = result.returncode == 0 and os.fsencode(site_path) not in failed
+            self._results.append((ok, str(site_path)))
 
 
 @dataclasses.dataclass
@@ -267,38 +431,97 @@ class SiteController:
         self._console = console
 
     def restart_services(self, gui: bool, full: bool) -> None:
-        if gui and not full:
-            self._restart_checkmk_core()
-            self._restart_apache()
-            self._restart_ui_scheduler()
-        elif full:
-            self._restart_site()
-
-    def _restart_site(self) -> None:
-        result = self._execute("omd restart")
-        self._print_result("Restart all services", result)
-
-    def _restart_checkmk_core(self) -> None:
-        result = self._execute("cmk -R")
-        self._print_result("Restart Checkmk", result)
-
-    def _restart_apache(self) -> None:
-        result = self._execute("omd reload apache")
-        self._print_result("Restart Apache", result)
-
-    def _restart_ui_scheduler(self) -> None:
-        result = self._execute("omd restart ui-job-scheduler")
-        self._print_result("Restart UI Job Scheduler", result)
-
-    def _execute(self, cmd: str) -> CompletedProcess:
-        reload_cmd = f"sudo --login -u {self._site} -- {cmd}"
-        return subprocess.run(reload_cmd.split(), capture_output=True, text=True)
-
-    def _print_result(self, heading: str, result: CompletedProcess) -> None:
-        self._console.heading(heading)
+        if full:
+            self._restart([("Restart all services", "omd restart")])
+        elif gui:
+            self._restart(
+                [
+                    ("Restart Checkmk", "cmk -R"),
+                    ("Restart Apache", "omd reload apache"),
+                    ("Restart UI Job Scheduler", "omd restart ui-job-scheduler"),
+                ]
+            )
+
+    def _restart(self, steps: list[tuple[str, str]]) -> None:
+        result = self._execute(steps)
+        self._print_result(result)
+
+    def _execute(self, steps: list[tuple[str, str]]) -> CompletedProcess:
+        # A single login shell runs all steps, so the site profile is sourced
+        # once. Markers are echoed in between to split the output per step.
+        script = " && ".join(
+            f"echo '{STEP_MARKER}{heading}{STEP_MARKER}' && {cmd}"
+            for heading, cmd in steps
+        )
+        args = ["sudo", "--login", "-u", self._site, "--", "sh", "-c", script]
+        with subprocess.Popen(args, stdout=PIPE, stderr=PIPE) as proc:
+            assert proc.stdout is not None and proc.stderr is not None
+            # Drain stderr in the background, so neither pipe can fill up and
+            # block the other while errors keep their own style.
+            errors = threading.Thread(
+                target=self._print_stream, args=(proc.stderr, "danger")
+            )
+            errors.start()
+            self._print_stream(proc.stdout, "muted")
+            errors.join()
+        return CompletedProcess(args, proc.returncode)
+
+    def _print_stream(self, stream: IO[bytes], style: StyleVariant) -> None:
+        for raw_line in stream:
+            line = raw_line.decode("utf-8", "replace").rstrip()
+            if line.startswith(STEP_MARKER) and line.endswith(STEP_MARKER):
+                self._console.heading(line.strip(STEP_MARKER))
+            else:
+                self._console.print(line, style=style)
+
+    def _print_result(self, result: CompletedProcess) -> None:
         if result.returncode != 0:
-            self._console.print(f"ERROR: {result.stderr}", style="danger")
-        self._console.print(result.stdout, style="muted")
+            msg = f"ERROR: exited with status {result.returncode}"
+            self._console.print(msg, style="danger")
+
+
+@contextlib.contextmanager
+def sudo_session(console: AppConsole) -> Iterator[None]:
+    """Authenticate once up-front and keep the sudo credentials cached."""
+    if subprocess.run(["sudo", "-v"]).returncode != 0:
+        console.exit("Unable to acquire sudo privileges.", style="danger")
+
+    stop = threading.Event()
+
+    def refresh() -> None:
+        while not stop.wait(SUDO_REFRESH_INTERVAL):
+            subprocess.run(["sudo", "-n", "-v"], capture_output=True)
+
+    threading.Thread(target=refresh, daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def cached_output(key: str, ttl: float, producer: Callable[[], bytes]) -> bytes:
+    """Return the cached output for key if younger than ttl, else refresh it."""
+    cache_file = CACHE_DIR / key
+    with contextlib.suppress(OSError):
+        fresh = time.time() - cache_file.stat().st_mtime < ttl
+        if fresh and (output := cache_file.read_bytes()):
+            return output
+
+    if not (output := producer()):
+        return output
+    # Write next to the cache file and swap it in, so neither a failed write
+    # nor a concurrent run can leave a truncated file that looks fresh.
+    with contextlib.suppress(OSError):
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=CACHE_DIR, prefix=f".{key}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(output)
+            os.replace(tmp_name, cache_file)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_name)
+    return output
 
 
 if __name__ == "__main__":